@@ -1,17 +1,62 @@
 import base64
 import hashlib
+import hmac
 import uuid
 import os
 import json
-import boto3
 import time
-from twilio.request_validator import RequestValidator
-from twilio.rest import Client
-from urllib.parse import parse_qs
+import urllib.request
+from botocore.config import Config
+from botocore.session import Session
+from urllib.parse import parse_qsl, quote
 
+try:
+    import orjson
 
-SECRETS_CLIENT = boto3.client("secretsmanager")
-SQS_CLIENT = boto3.client("sqs")
+    json_loads = orjson.loads
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode("utf-8")
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
+
+
+# -- deployment configuration, read once per execution environment.
+QUEUE_URL = os.environ.get("SQS_QUEUE_URL")
+SECRET_NAME = os.environ.get("TWILIO_SECRET_NAME", "twilio-sms-to-sqs")
+
+# -- clients are created once per execution environment and reused across warm invocations.
+# -- Lambda handles one request at a time, so a single kept-alive connection suffices. SendMessage is
+# -- not retried, so the worst case is the 1 s secrets fetch plus 1 s connect and 2 s read to SQS (~4 s),
+# -- which stays within the 5 s function timeout in template.yaml.
+SQS_CONFIG = Config(
+    max_pool_connections=1,
+    retries={"max_attempts": 1, "mode": "standard"},
+    connect_timeout=1,
+    read_timeout=2,
+    tcp_keepalive=True
+)
+# -- botocore is used directly to avoid importing boto3's resource layer.
+_SESSION = Session()
+SQS_CLIENT = _SESSION.create_client("sqs", config=SQS_CONFIG)
+TWILIO_CLIENT = None
+TWILIO_CLIENT_CREDENTIALS = None
+
+# -- SendMessageBatch accepts at most 10 entries per request.
+SQS_MAX_BATCH_SIZE = 10
+
+# -- AWS Parameters and Secrets Lambda Extension local HTTP endpoint.
+SECRETS_EXTENSION_ENDPOINT = "http://localhost:{}/secretsmanager/get?secretId=".format(
+    os.environ.get("PARAMETERS_SECRETS_EXTENSION_HTTP_PORT", "2773")
+)
+
+# -- decoded secrets are cached per secret name as (secrets, fetched_at) for _SECRETS_TTL seconds.
+_SECRETS_CACHE = {}
+_SECRETS_TTL = 300
+REQUIRED_TWILIO_SECRETS = {"TWILIO_AUTH_TOKEN", "TWILIO_ACCOUNT_SID"}
+
+EMPTY_TWIML_RESPONSE = '<?xml version="1.0" encoding="UTF-8"?><Response/>'
 
 
 def send_sms(body: str, recipient: str, sender: str, account_sid: str, auth_token: str) -> None:
@@ -25,10 +70,16 @@ def send_sms(body: str, recipient: str, sender: str, account_sid: str, auth_toke
         account_sid: str, required, the Twilio account SID.
         auth_token: str, required, the Twilio auth token.
     """
-    client = Client(account_sid, auth_token)
+    global TWILIO_CLIENT, TWILIO_CLIENT_CREDENTIALS
+    # -- rebuild the client if the credentials changed, e.g. after the auth token was rotated.
+    if TWILIO_CLIENT is None or TWILIO_CLIENT_CREDENTIALS != (account_sid, auth_token):
+        # -- imported lazily: the REST resource tree is heavy and not needed to validate and enqueue.
+        from twilio.rest import Client
+        TWILIO_CLIENT = Client(account_sid, auth_token)
+        TWILIO_CLIENT_CREDENTIALS = (account_sid, auth_token)
 
     # -- send a response using the Twilio API
-    response = client.messages.create(
+    response = TWILIO_CLIENT.messages.create(
         body=body,
         from_=sender,
         to=recipient
@@ -37,7 +88,10 @@ def send_sms(body: str, recipient: str, sender: str, account_sid: str, auth_toke
 
 def load_twilio_secrets(secret_name: str) -> dict:
     """
-    Load Twilio secrets from AWS Secrets Manager.
+    Load Twilio secrets from AWS Secrets Manager via the AWS Parameters and Secrets Lambda Extension,
+    which serves (and caches) secrets over localhost instead of a signed SDK call. Secrets are also
+    cached in the execution environment for `_SECRETS_TTL` seconds so that warm invocations skip
+    the round-trip entirely.
     Requires that the secret contains the following secret strings:
     "TWILIO_AUTH_TOKEN", "TWILIO_ACCOUNT_SID"
 
@@ -45,11 +99,23 @@ def load_twilio_secrets(secret_name: str) -> dict:
         secret_name: str, required, the name of the secret in AWS Secrets Manager.
     Returns:
         dict[str, str], Twilio secrets.
+    Raises:
+        KeyError, if any of the required Twilio secrets are missing.
     """
-    response = SECRETS_CLIENT.get_secret_value(SecretId=secret_name)
-    secrets = json.loads(response["SecretString"])
-    secret_names = ["TWILIO_AUTH_TOKEN", "TWILIO_ACCOUNT_SID"]
-    assert all(secret_name in secrets for secret_name in secret_names), "Missing Twilio secrets."
+    entry = _SECRETS_CACHE.get(secret_name)
+    if entry and time.monotonic() - entry[1] < _SECRETS_TTL:
+        return entry[0]
+
+    request = urllib.request.Request(
+        SECRETS_EXTENSION_ENDPOINT + quote(secret_name),
+        headers={"X-Aws-Parameters-Secrets-Token": os.environ["AWS_SESSION_TOKEN"]}
+    )
+    with urllib.request.urlopen(request, timeout=1) as response:
+        secrets = json_loads(json_loads(response.read())["SecretString"])
+    missing = REQUIRED_TWILIO_SECRETS - secrets.keys()
+    if missing:
+        raise KeyError(f"Missing Twilio secrets: {missing}")
+    _SECRETS_CACHE[secret_name] = (secrets, time.monotonic())
     return secrets
 
 
@@ -64,25 +130,84 @@ def get_event_body(event: dict) -> dict:
         - https://stackoverflow.com/questions/77584306/unable-to-validate-twilio-incoming-sms-webhook-with-aws-lambda
     """
     if event.get("isBase64Encoded", False):
-        body_str = base64.b64decode(event["body"]).decode("utf-8")
+        # -- form-urlencoded payloads are percent-encoded, hence pure ASCII.
+        body_str = base64.b64decode(event["body"]).decode("ascii")
     else:
         body_str = event["body"]
 
-    body_dict = parse_qs(body_str, keep_blank_values=True)
-    json_body = {k: v[0] for k, v in body_dict.items()}
-    return json_body
+    return dict(parse_qsl(body_str, keep_blank_values=True))
 
 
-def validate_sms_from_twilio(event: dict, auth_token: str) -> bool:
+def validate_sms_from_twilio(event: dict, post_vars: dict, auth_token: str) -> bool:
     """
     Verify that the incoming SMS message was sent from Twilio by generating a signature
     and comparing it to the signature provided in the event headers.
+
+    Implements Twilio's signature scheme directly rather than through `twilio.request_validator`:
+    the base64-encoded HMAC-SHA1, keyed on the auth token, of the full request URL followed by
+    each POST parameter name and value, sorted by name. As with the SDK, the signature is accepted
+    if it matches the URL either without or with its port (":443" unless the host names another one).
+
+    Args:
+        event: dict, required, API Gateway Lambda Proxy Input Format event.
+        post_vars: dict, required, the event body as parsed by `get_event_body`.
+        auth_token: str, required, the Twilio auth token.
+    """
+    hostname, _, port = event["headers"]["host"].partition(":")
+    path = event["requestContext"]["http"]["path"]
+    params = "".join(k + post_vars[k] for k in sorted(post_vars))
+    key = auth_token.encode("utf-8")
+    provided = event["headers"]["x-twilio-signature"].encode("utf-8")
+
+    is_valid = False
+    for url in ("https://" + hostname + path, "https://" + hostname + ":" + (port or "443") + path):
+        mac = hmac.new(key, (url + params).encode("utf-8"), hashlib.sha1).digest()
+        # -- evaluate both variants rather than short-circuiting, so timing does not reveal which one matched.
+        is_valid |= hmac.compare_digest(base64.b64encode(mac), provided)
+    return is_valid
+
+
+def _serialize_sms_message(message: dict) -> str:
+    """
+    Serialize an SMS message to JSON. The message always has the same three string fields,
+    so only the values need JSON-escaping and the surrounding object is a fixed template.
+    """
+    return '{"from_":%s,"to":%s,"text":%s}' % (
+        json_dumps(message["from_"]),
+        json_dumps(message["to"]),
+        json_dumps(message["text"])
+    )
+
+
+def _enqueue(queue_url: str, messages: list[dict]) -> None:
+    """
+    Send SMS messages to the SQS FIFO queue in batches of up to 10 entries, so that
+    N messages cost ceil(N / 10) SQS requests instead of N.
+
+    Each message is deduplicated on its sender, text, and the current time (to the second) and grouped by sender.
+
+    Args:
+        queue_url: str, required, URL of the SQS FIFO queue.
+        messages: list[dict], required, messages with "from_", "to", and "text" fields.
     """
-    validator = RequestValidator(auth_token)
-    post_vars = get_event_body(event)
-    url = "https://" + event["headers"]["host"] + event["requestContext"]["http"]["path"]
-    twilio_signature = event["headers"]["x-twilio-signature"]
-    return validator.validate(url, post_vars, twilio_signature)
+    timestamp = str(int(time.time()))
+    for start in range(0, len(messages), SQS_MAX_BATCH_SIZE):
+        chunk = messages[start:start + SQS_MAX_BATCH_SIZE]
+        entries = []
+        for i, message in enumerate(chunk):
+            # -- create deduplication ID.
+            hash_items = [message["from_"], message["text"], timestamp]
+            hashed_combined_string = hashlib.sha256(", ".join(hash_items).encode("utf-8")).digest()
+            entries.append({
+                "Id": str(i),
+                "MessageBody": _serialize_sms_message(message),
+                "MessageDeduplicationId": str(uuid.UUID(bytes=hashed_combined_string[:16])),
+                "MessageGroupId": message["from_"]
+            })
+
+        response = SQS_CLIENT.send_message_batch(QueueUrl=queue_url, Entries=entries)
+        if response.get("Failed"):
+            raise RuntimeError(f"Failed to send messages to SQS: {response['Failed']}")
 
 
 def lambda_handler(event, context):
@@ -100,26 +225,31 @@ def lambda_handler(event, context):
             Event doc: https://docs.aws.amazon.com/apigateway/latest/developerguide/set-up-lambda-proxy-integrations.html#api-gateway-simple-proxy-for-lambda-input-format
     """
 
-    secrets = load_twilio_secrets(os.environ["TWILIO_SECRET_NAME"])
+    secrets = load_twilio_secrets(SECRET_NAME)
     try:
+        # -- parse the body once; it is used for both validation and message extraction.
+        message_data = get_event_body(event)
+
         # -- validate the request
-        if not validate_sms_from_twilio(event, auth_token=secrets["TWILIO_AUTH_TOKEN"]):
-            return {"statusCode": 400, "body": "Could not validate Twilio signature."}
+        if not validate_sms_from_twilio(event, message_data, auth_token=secrets["TWILIO_AUTH_TOKEN"]):
+            return {
+                "statusCode": 400,
+                "body": "Could not validate Twilio signature.",
+                "headers": {"Content-Type": "text/plain"}
+            }
     except Exception as e:
         print(f"Exception: {e}")
-        return {"status_code": 500, "body": "Encountered exception while trying to validate Twilio event."}
+        return {
+            "statusCode": 500,
+            "body": "Encountered exception while trying to validate Twilio event.",
+            "headers": {"Content-Type": "text/plain"}
+        }
 
     # -- extract the message and sender info from the event
-    message_data = get_event_body(event)
     from_number = message_data["From"]
     twilio_phone_number = message_data["To"]
     message_text = message_data["Body"]
 
-    # -- create deduplication ID.
-    hash_items = [message_text, str(int(time.time()))]
-    hashed_combined_string = hashlib.sha256(", ".join(hash_items).encode("utf-8")).digest()
-    deduplication_id = str(uuid.UUID(bytes=hashed_combined_string[:16]))
-
     sqs_message = {
         "from_": from_number,
         "to": twilio_phone_number,
@@ -127,12 +257,51 @@ def lambda_handler(event, context):
     }
 
     # -- send message to SQS FIFO queue with deduplication parameters.
-    queue_url = os.environ.get("SQS_QUEUE_URL")
-    SQS_CLIENT.send_message(
-        QueueUrl=queue_url,
-        MessageBody=json.dumps(sqs_message),
-        MessageDeduplicationId=deduplication_id,
-        MessageGroupId=from_number
-    )
+    _enqueue(QUEUE_URL, [sqs_message])
+
+    # -- acknowledge with empty TwiML so that Twilio does not send a reply or log an error.
+    return {"statusCode": 200, "body": EMPTY_TWIML_RESPONSE, "headers": {"Content-Type": "text/xml"}}
+
+
+def process_sms_message(message: dict) -> None:
+    """
+    Process a single SMS message pulled from the SQS queue. This is the extension point for
+    downstream business logic, e.g. replying to the sender with `send_sms`, and is a no-op by default.
+    Raise an exception to report the message as a batch item failure.
+
+    Args:
+        message: dict, required, message with "from_", "to", and "text" fields.
+    """
+
+
+def sqs_handler(event, context):
+    """
+    Process a batch of SMS messages delivered by the SQS event source mapping on the SMS queue.
+
+    Uses partial batch responses so that only failed messages are returned to the queue. The queue is
+    FIFO, so once a message fails, it and every later message in the same message group are reported as
+    failures to preserve ordering within that group. Messages in other groups are still processed.
+
+    Args:
+        event: dict, required
+            SQS Lambda Input Format
+            Event doc: https://docs.aws.amazon.com/lambda/latest/dg/with-sqs.html
+    Returns:
+        dict, partial batch response listing the message IDs that failed.
+    """
+    failed_groups = set()
+    failures = []
+    for record in event["Records"]:
+        group_id = record["attributes"]["MessageGroupId"]
+        if group_id in failed_groups:
+            failures.append({"itemIdentifier": record["messageId"]})
+            continue
+
+        try:
+            process_sms_message(json_loads(record["body"]))
+        except Exception as e:
+            print(f"Exception processing message {record['messageId']}: {type(e).__name__}")
+            failed_groups.add(group_id)
+            failures.append({"itemIdentifier": record["messageId"]})
 
-    return {"status_code": 200, "body": f"Hello from {from_number}! Received: {message_text}"}
+    return {"batchItemFailures": failures}
@@ -1,72 +1,324 @@
+import base64
 import json
+import os
 
 import pytest
 
-from hello_world import app
+# -- the SQS client is created at import time and needs a region.
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+from sms_to_sqs import app
 
 
 @pytest.fixture()
 def apigw_event():
-    """ Generates API GW Event"""
+    """ Generates an HTTP API (payload format 2.0) event carrying a Twilio SMS webhook"""
 
     return {
-        "body": '{ "test": "body"}',
-        "resource": "/{proxy+}",
+        "version": "2.0",
+        "routeKey": "POST /sms",
+        "rawPath": "/dev/sms",
+        "headers": {
+            "content-type": "application/x-www-form-urlencoded",
+            "host": "1234567890.execute-api.us-east-1.amazonaws.com",
+            "x-twilio-signature": "signature",
+        },
         "requestContext": {
-            "resourceId": "123456",
-            "apiId": "1234567890",
-            "resourcePath": "/{proxy+}",
-            "httpMethod": "POST",
-            "requestId": "c6af9ac6-7b61-11e6-9a41-93e8deadbeef",
             "accountId": "123456789012",
-            "identity": {
-                "apiKey": "",
-                "userArn": "",
-                "cognitoAuthenticationType": "",
-                "caller": "",
-                "userAgent": "Custom User Agent String",
-                "user": "",
-                "cognitoIdentityPoolId": "",
-                "cognitoIdentityId": "",
-                "cognitoAuthenticationProvider": "",
+            "apiId": "1234567890",
+            "http": {
+                "method": "POST",
+                "path": "/dev/sms",
+                "protocol": "HTTP/1.1",
                 "sourceIp": "127.0.0.1",
-                "accountId": "",
+                "userAgent": "TwilioProxy/1.1",
             },
-            "stage": "prod",
-        },
-        "queryStringParameters": {"foo": "bar"},
-        "headers": {
-            "Via": "1.1 08f323deadbeefa7af34d5feb414ce27.cloudfront.net (CloudFront)",
-            "Accept-Language": "en-US,en;q=0.8",
-            "CloudFront-Is-Desktop-Viewer": "true",
-            "CloudFront-Is-SmartTV-Viewer": "false",
-            "CloudFront-Is-Mobile-Viewer": "false",
-            "X-Forwarded-For": "127.0.0.1, 127.0.0.2",
-            "CloudFront-Viewer-Country": "US",
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-            "Upgrade-Insecure-Requests": "1",
-            "X-Forwarded-Port": "443",
-            "Host": "1234567890.execute-api.us-east-1.amazonaws.com",
-            "X-Forwarded-Proto": "https",
-            "X-Amz-Cf-Id": "aaaaaaaaaae3VYQb9jd-nvCd-de396Uhbp027Y2JvkCPNLmGJHqlaA==",
-            "CloudFront-Is-Tablet-Viewer": "false",
-            "Cache-Control": "max-age=0",
-            "User-Agent": "Custom User Agent String",
-            "CloudFront-Forwarded-Proto": "https",
-            "Accept-Encoding": "gzip, deflate, sdch",
+            "stage": "dev",
         },
-        "pathParameters": {"proxy": "/examplepath"},
-        "httpMethod": "POST",
-        "stageVariables": {"baz": "qux"},
-        "path": "/examplepath",
+        "body": "From=%2B15555550100&To=%2B15555550199&Body=Hello&MessageSid=SM123",
+        "isBase64Encoded": False,
     }
 
 
-def test_lambda_handler(apigw_event, mocker):
+@pytest.fixture()
+def sqs_client(mocker):
+    """ Replaces the module-level SQS client with a stub that accepts every message"""
+
+    client = mocker.Mock()
+    client.send_message_batch.return_value = {"Successful": [], "Failed": []}
+    mocker.patch.object(app, "SQS_CLIENT", client)
+    return client
+
+
+@pytest.fixture(autouse=True)
+def clear_secrets_cache():
+    """ Keeps cached Twilio secrets from carrying over between tests"""
+
+    app._SECRETS_CACHE.clear()
+    yield
+    app._SECRETS_CACHE.clear()
+
+
+@pytest.fixture()
+def secrets_extension(mocker, monkeypatch):
+    """ Stubs the Parameters and Secrets Lambda Extension HTTP endpoint with valid Twilio secrets"""
+
+    monkeypatch.setenv("AWS_SESSION_TOKEN", "session-token")
+    urlopen = mocker.patch("urllib.request.urlopen")
+    set_secret_string(urlopen, {"TWILIO_AUTH_TOKEN": "token", "TWILIO_ACCOUNT_SID": "AC123"})
+    return urlopen
+
+
+def set_secret_string(urlopen, secrets):
+    response = {"Name": "twilio-sms-to-sqs", "SecretString": json.dumps(secrets)}
+    urlopen.return_value.__enter__.return_value.read.return_value = json.dumps(response).encode("utf-8")
+
+
+def sms_message(i):
+    return {"from_": f"+1555555{i:04d}", "to": "+15555550199", "text": f"message {i}"}
+
+
+def sqs_record(message_id, body, group_id="+15555550100"):
+    return {"messageId": message_id, "body": body, "attributes": {"MessageGroupId": group_id}}
+
+
+def test_lambda_handler(apigw_event, sqs_client, mocker):
+    mocker.patch.object(app, "load_twilio_secrets", return_value={"TWILIO_AUTH_TOKEN": "token"})
+    mocker.patch.object(app, "validate_sms_from_twilio", return_value=True)
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 200
+    assert ret["headers"]["Content-Type"] == "text/xml"
+    assert ret["body"] == app.EMPTY_TWIML_RESPONSE
+
+    entries = sqs_client.send_message_batch.call_args.kwargs["Entries"]
+    assert len(entries) == 1
+    assert entries[0]["MessageGroupId"] == "+15555550100"
+    assert json.loads(entries[0]["MessageBody"]) == {"from_": "+15555550100", "to": "+15555550199", "text": "Hello"}
+
+
+def test_lambda_handler_invalid_signature(apigw_event, sqs_client, mocker):
+    mocker.patch.object(app, "load_twilio_secrets", return_value={"TWILIO_AUTH_TOKEN": "token"})
+    mocker.patch.object(app, "validate_sms_from_twilio", return_value=False)
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 400
+    sqs_client.send_message_batch.assert_not_called()
+
+
+def test_lambda_handler_malformed_event(apigw_event, sqs_client, mocker):
+    mocker.patch.object(app, "load_twilio_secrets", return_value={"TWILIO_AUTH_TOKEN": "token"})
+    del apigw_event["headers"]["x-twilio-signature"]
+
+    ret = app.lambda_handler(apigw_event, "")
+
+    assert ret["statusCode"] == 500
+    sqs_client.send_message_batch.assert_not_called()
+
+
+# -- reference signatures computed with twilio.request_validator.RequestValidator for auth token "12345" and
+# -- the apigw_event URL, https://1234567890.execute-api.us-east-1.amazonaws.com/dev/sms.
+AUTH_TOKEN = "12345"
+SIGNED_BODIES = {
+    "From=%2B15555550100&To=%2B15555550199&Body=Hello&MessageSid=SM123": {
+        "no_port": "wS384E3YCCYen7I3eBBJnjoR5IM=",
+        "with_port": "8eJK3anFGHyNxh7sw0MrrxX/bhI=",
+    },
+    "From=%2B15555550100&To=%2B15555550199&Body=&MessageSid=SM123": {
+        "no_port": "3nJ3q0WrXZZpRWXxn26+EIhrdwU=",
+        "with_port": "Li6aJqfjRmhaoyPSvUAtvNg9F88=",
+    },
+    "From=%2B15555550100&To=%2B15555550199&Body=caf%C3%A9+%E2%98%95&MessageSid=SM123": {
+        "no_port": "q+tLi3QDW982j1jYmzCG536dbN4=",
+        "with_port": "+p9K6xK+fPLAGd9fX//v8qFC3UI=",
+    },
+}
+
+
+def validate(event):
+    return app.validate_sms_from_twilio(event, app.get_event_body(event), auth_token=AUTH_TOKEN)
+
+
+@pytest.mark.parametrize("body", SIGNED_BODIES)
+@pytest.mark.parametrize("variant", ["no_port", "with_port"])
+def test_validate_sms_from_twilio(apigw_event, body, variant):
+    apigw_event["body"] = body
+    apigw_event["headers"]["x-twilio-signature"] = SIGNED_BODIES[body][variant]
+
+    assert validate(apigw_event)
+
+
+def test_validate_sms_from_twilio_base64_body(apigw_event):
+    body = "From=%2B15555550100&To=%2B15555550199&Body=caf%C3%A9+%E2%98%95&MessageSid=SM123"
+    apigw_event["body"] = base64.b64encode(body.encode("ascii")).decode("ascii")
+    apigw_event["isBase64Encoded"] = True
+    apigw_event["headers"]["x-twilio-signature"] = SIGNED_BODIES[body]["no_port"]
+
+    assert app.get_event_body(apigw_event)["Body"] == "caf\u00e9 \u2615"
+    assert validate(apigw_event)
+
+
+def test_validate_sms_from_twilio_keeps_blank_values(apigw_event):
+    body = "From=%2B15555550100&To=%2B15555550199&Body=&MessageSid=SM123"
+    apigw_event["body"] = body
+    apigw_event["headers"]["x-twilio-signature"] = SIGNED_BODIES[body]["no_port"]
+    post_vars = app.get_event_body(apigw_event)
+
+    assert post_vars["Body"] == ""
+    # -- dropping the blank parameter changes the signed payload.
+    del post_vars["Body"]
+    assert not app.validate_sms_from_twilio(apigw_event, post_vars, auth_token=AUTH_TOKEN)
+
+
+@pytest.mark.parametrize("signature", [
+    "wS384E3YCCYen7I3eBBJnjoR5IN=",
+    "8eJK3anFGHyNxh7sw0MrrxX/bhI=\u00e9",
+    "",
+])
+def test_validate_sms_from_twilio_rejects_bad_signature(apigw_event, signature):
+    apigw_event["headers"]["x-twilio-signature"] = signature
+
+    assert not validate(apigw_event)
+
+
+def test_validate_sms_from_twilio_rejects_wrong_token(apigw_event):
+    apigw_event["headers"]["x-twilio-signature"] = SIGNED_BODIES[apigw_event["body"]]["no_port"]
+
+    assert not app.validate_sms_from_twilio(apigw_event, app.get_event_body(apigw_event), auth_token="54321")
+
+
+def test_lambda_handler_signed_request(apigw_event, sqs_client, mocker):
+    mocker.patch.object(app, "load_twilio_secrets", return_value={"TWILIO_AUTH_TOKEN": AUTH_TOKEN})
+    apigw_event["headers"]["x-twilio-signature"] = SIGNED_BODIES[apigw_event["body"]]["with_port"]
 
     ret = app.lambda_handler(apigw_event, "")
-    data = json.loads(ret["body"])
 
     assert ret["statusCode"] == 200
-    assert "message" in ret["body"]
-    assert data["message"] == "hello world"
+    sqs_client.send_message_batch.assert_called_once()
+
+
+def test_enqueue_chunks_into_batches_of_ten(sqs_client):
+    messages = [sms_message(i) for i in range(23)]
+
+    app._enqueue("queue-url", messages)
+
+    batches = [call.kwargs["Entries"] for call in sqs_client.send_message_batch.call_args_list]
+    assert [len(entries) for entries in batches] == [10, 10, 3]
+    for entries in batches:
+        assert [entry["Id"] for entry in entries] == [str(i) for i in range(len(entries))]
+
+    sent = [json.loads(entry["MessageBody"]) for entries in batches for entry in entries]
+    assert sent == messages
+    assert [entry["MessageGroupId"] for entries in batches for entry in entries] == [m["from_"] for m in messages]
+
+
+def test_enqueue_deduplication_ids_differ_across_senders(sqs_client):
+    messages = [
+        {"from_": "+1", "to": "+15555550199", "text": "hi"},
+        {"from_": "+2", "to": "+15555550199", "text": "hi"},
+    ]
+
+    app._enqueue("queue-url", messages)
+
+    entries = sqs_client.send_message_batch.call_args.kwargs["Entries"]
+    assert entries[0]["MessageDeduplicationId"] != entries[1]["MessageDeduplicationId"]
+
+
+def test_enqueue_raises_on_failed_entries(sqs_client):
+    sqs_client.send_message_batch.return_value = {
+        "Successful": [],
+        "Failed": [{"Id": "0", "SenderFault": False, "Code": "InternalError"}],
+    }
+
+    with pytest.raises(RuntimeError):
+        app._enqueue("queue-url", [sms_message(0)])
+
+
+def test_sqs_handler_processes_batch(mocker):
+    process = mocker.patch.object(app, "process_sms_message")
+    records = [sqs_record(str(i), json.dumps(sms_message(i))) for i in range(3)]
+
+    ret = app.sqs_handler({"Records": records}, "")
+
+    assert ret == {"batchItemFailures": []}
+    assert [call.args[0] for call in process.call_args_list] == [sms_message(i) for i in range(3)]
+
+
+def test_sqs_handler_fails_record_and_all_after_it_in_group(mocker):
+    process = mocker.patch.object(app, "process_sms_message")
+    records = [
+        sqs_record("a", json.dumps(sms_message(0))),
+        sqs_record("b", "not json"),
+        sqs_record("c", json.dumps(sms_message(2))),
+    ]
+
+    ret = app.sqs_handler({"Records": records}, "")
+
+    assert ret == {"batchItemFailures": [{"itemIdentifier": "b"}, {"itemIdentifier": "c"}]}
+    # -- records after the first failure must not be processed, to preserve FIFO ordering.
+    assert process.call_count == 1
+
+
+def test_sqs_handler_processes_other_groups_after_failure(mocker):
+    process = mocker.patch.object(app, "process_sms_message")
+    records = [
+        sqs_record("a1", "not json", group_id="+1"),
+        sqs_record("b1", json.dumps(sms_message(1)), group_id="+2"),
+        sqs_record("a2", json.dumps(sms_message(2)), group_id="+1"),
+        sqs_record("b2", json.dumps(sms_message(3)), group_id="+2"),
+    ]
+
+    ret = app.sqs_handler({"Records": records}, "")
+
+    assert ret == {"batchItemFailures": [{"itemIdentifier": "a1"}, {"itemIdentifier": "a2"}]}
+    assert [call.args[0] for call in process.call_args_list] == [sms_message(1), sms_message(3)]
+
+
+def test_send_sms_reuses_client_until_credentials_change(mocker):
+    mocker.patch.object(app, "TWILIO_CLIENT", None)
+    mocker.patch.object(app, "TWILIO_CLIENT_CREDENTIALS", None)
+    client_cls = mocker.patch("twilio.rest.Client")
+
+    app.send_sms("hi", "+15555550100", "+15555550199", account_sid="AC123", auth_token="token")
+    app.send_sms("hi", "+15555550100", "+15555550199", account_sid="AC123", auth_token="token")
+    assert client_cls.call_count == 1
+
+    app.send_sms("hi", "+15555550100", "+15555550199", account_sid="AC123", auth_token="rotated")
+    assert client_cls.call_count == 2
+    client_cls.assert_called_with("AC123", "rotated")
+    assert client_cls.return_value.messages.create.call_count == 3
+
+
+def test_load_twilio_secrets_caches_for_ttl(secrets_extension, mocker):
+    monotonic = mocker.patch("time.monotonic", return_value=1000.0)
+
+    secrets = app.load_twilio_secrets("twilio-sms-to-sqs")
+    assert secrets["TWILIO_AUTH_TOKEN"] == "token"
+
+    monotonic.return_value = 1000.0 + app._SECRETS_TTL - 1
+    assert app.load_twilio_secrets("twilio-sms-to-sqs") == secrets
+    assert secrets_extension.call_count == 1
+
+    monotonic.return_value = 1000.0 + app._SECRETS_TTL
+    app.load_twilio_secrets("twilio-sms-to-sqs")
+    assert secrets_extension.call_count == 2
+
+
+def test_load_twilio_secrets_from_extension(secrets_extension):
+    secrets = app.load_twilio_secrets("twilio/sms to sqs")
+
+    assert secrets == {"TWILIO_AUTH_TOKEN": "token", "TWILIO_ACCOUNT_SID": "AC123"}
+    request = secrets_extension.call_args.args[0]
+    assert request.full_url == "http://localhost:2773/secretsmanager/get?secretId=twilio/sms%20to%20sqs"
+    assert request.get_header("X-aws-parameters-secrets-token") == "session-token"
+    assert secrets_extension.call_args.kwargs["timeout"] == 1
+
+
+def test_load_twilio_secrets_rejects_missing_secret(secrets_extension):
+    set_secret_string(secrets_extension, {"TWILIO_AUTH_TOKEN": "token"})
+
+    with pytest.raises(KeyError, match="TWILIO_ACCOUNT_SID"):
+        app.load_twilio_secrets("twilio-sms-to-sqs")
+    assert "twilio-sms-to-sqs" not in app._SECRETS_CACHE